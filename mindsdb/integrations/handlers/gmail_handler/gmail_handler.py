@@ -1,4 +1,5 @@
 import json
+from functools import partial
 from shutil import copyfile
 
 import requests
@@ -15,16 +16,21 @@ from mindsdb_sql import parse_sql
 from mindsdb.interfaces.storage.model_fs import HandlerStorage
 
 import os
+import random
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from typing import List
 import pandas as pd
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from email.message import EmailMessage
+from googleapiclient.http import build_http
+from email.message import EmailMessage, Message
 
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
@@ -32,10 +38,104 @@ DEFAULT_SCOPES = ['https://www.googleapis.com/auth/gmail.compose',
                   'https://www.googleapis.com/auth/gmail.readonly',
                   'https://www.googleapis.com/auth/gmail.modify']
 
+# Headers used to fill the emails table, mapped to their columns
+MESSAGE_HEADER_COLUMNS = {
+    'From': 'sender',
+    'To': 'to',
+    'Date': 'date',
+    'Subject': 'subject',
+    'Message-ID': 'message_id',
+}
+MESSAGE_HEADERS = list(MESSAGE_HEADER_COLUMNS)
+
+# Partial response masks, only the fields read by the handler are requested
+LIST_MESSAGES_FIELDS = 'messages/id,nextPageToken'
+MESSAGE_FIELDS = {
+    'full': 'id,threadId,labelIds,snippet,historyId,sizeEstimate,payload(mimeType,filename,headers,body,parts)',
+    'metadata': 'id,threadId,labelIds,snippet,historyId,sizeEstimate,payload/headers',
+}
+
+# Supported WHERE clauses mapped to "users.messages.list" parameters
+LIST_MESSAGES_PARAMS = {
+    'query': 'q',
+    'label_ids': 'labelIds',
+    'include_spam_trash': 'includeSpamTrash',
+}
+
+# Quota cost of "users.messages.get" and the per-user quota of the Gmail API
+MESSAGE_GET_QUOTA_UNITS = 5
+QUOTA_UNITS_PER_SECOND = 250
+
+# Header names are case-insensitive, lookups are done on the lowercased name
+_HEADER_COLUMNS_BY_NAME = {name.lower(): column for name, column in MESSAGE_HEADER_COLUMNS.items()}
+
+
+def _decode_text_part(part: dict) -> str:
+    """Decode a text part using the charset from its Content-Type header"""
+    content_type = Message()
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            content_type['Content-Type'] = header['value']
+    charset = content_type.get_content_charset('utf-8')
+    data = _decode_base64url(part.get('body', {}).get('data', ''))
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        # Unknown charset name in the header
+        return data.decode('utf-8', errors='replace')
+
+
+def _is_retryable(exception) -> bool:
+    """Only rate limit and server errors are worth retrying"""
+    return isinstance(exception, HttpError) and (exception.resp.status == 429 or exception.resp.status >= 500)
+
+
+def _retry_after(exception) -> float:
+    """Seconds to wait before retrying as asked by the Retry-After header, 0 if not set"""
+    try:
+        return float(exception.resp.get('retry-after', 0))
+    except ValueError:
+        # HTTP-date values are not used by the Gmail API
+        return 0
+
+
+def _clock() -> float:
+    """Clock used for the request timeout"""
+    return time.monotonic()
+
+
+def _sleep(delay: float, limit_exec_time: float, cancelled: threading.Event):
+    """Waits for delay seconds, gives up early if the listing is cancelled or would time out meanwhile"""
+    if _clock() + delay > limit_exec_time:
+        raise RuntimeError('Handler request timeout error')
+    if cancelled.wait(delay):
+        raise RuntimeError('Handler request cancelled')
+
+
+def _decode_base64url(data: str) -> bytes:
+    """Decodes base64url encoded data, restoring the padding Gmail may strip"""
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
 
 class EmailsTable(APITable):
     """Implementation for the emails table for Gmail"""
 
+    COLUMNS = (
+        'id',
+        'message_id',
+        'thread_id',
+        'label_ids',
+        'sender',
+        'to',
+        'date',
+        'subject',
+        'snippet',
+        'history_id',
+        'size_estimate',
+        'body',
+        'attachments',
+    )
+
     def select(self, query: ast.Select) -> pd.DataFrame:
         """Pulls emails from Gmail "users.messages.list" API
 
@@ -64,55 +164,54 @@ class EmailsTable(APITable):
             if op == 'or':
                 raise NotImplementedError(f'OR is not supported')
 
-            if arg1 in ['query', 'label_ids', 'include_spam_trash', 'include_attachments']:
-                if op == '=':
-                    if arg1 == 'query':
-                        params['q'] = arg2
-                    elif arg1 == 'label_ids':
-                        params['labelIds'] = arg2.split(',')
-                    elif arg1 == 'include_attachments':
-                        include_attachments = arg2 == 'true'
-                    else:
-                        params['includeSpamTrash'] = arg2
-                else:
-                    raise NotImplementedError(f'Unknown op: {op}')
+            if arg1 not in LIST_MESSAGES_PARAMS and arg1 != 'include_attachments':
+                raise NotImplementedError(f'Unknown clause: {arg1}')
 
+            if op != '=':
+                raise NotImplementedError(f'Unknown op: {op}')
+
+            if arg1 == 'include_attachments':
+                include_attachments = arg2 == 'true'
+            elif arg1 == 'label_ids':
+                params['labelIds'] = arg2.split(',')
             else:
-                raise NotImplementedError(f'Unknown clause: {arg1}')
+                params[LIST_MESSAGES_PARAMS[arg1]] = arg2
 
         if query.limit is not None:
             params['maxResults'] = query.limit.value
 
+        # filter targets
+        if any(isinstance(target, ast.Star) for target in query.targets):
+            columns = list(self.COLUMNS)
+        else:
+            columns = []
+            for target in query.targets:
+                if isinstance(target, ast.Identifier):
+                    # columns to lower case
+                    columns.append(target.parts[-1].lower())
+                else:
+                    raise NotImplementedError(f"Unknown query target {type(target)}")
+
+        # Message bodies are only downloaded when they are needed
+        if include_attachments or 'body' in columns or 'attachments' in columns:
+            message_format = 'full'
+        else:
+            message_format = 'metadata'
+
         result = self.handler.call_gmail_api(
             method_name='list_messages',
-            params=params
+            params=params,
+            message_format=message_format
         )
         attachments = []
         if include_attachments:
             attachments = self.handler.get_attachments(result)
-        # filter targets
-        columns = []
-        for target in query.targets:
-            if isinstance(target, ast.Star):
-                columns = self.get_columns()
-                break
-            elif isinstance(target, ast.Identifier):
-                columns.append(target.parts[-1])
-            else:
-                raise NotImplementedError(f"Unknown query target {type(target)}")
-
-        # columns to lower case
-        columns = [name.lower() for name in columns]
 
         if len(result) == 0:
             return pd.DataFrame([], columns=columns)
 
-        # add absent columns
-        for col in set(columns) & set(result.columns) ^ set(columns):
-            result[col] = None
-
-        # filter by columns
-        result = result[columns]
+        # filter by columns, absent columns are added empty
+        result = result.reindex(columns=columns)
 
         # Rename columns
         for target in query.targets:
@@ -129,21 +228,7 @@ class EmailsTable(APITable):
         List[str]
             List of columns
         """
-        return [
-            'id',
-            'message_id',
-            'thread_id',
-            'label_ids',
-            'sender',
-            'to',
-            'date',
-            'subject',
-            'snippet',
-            'history_id',
-            'size_estimate',
-            'body',
-            'attachments',
-        ]
+        return list(self.COLUMNS)
 
     def insert(self, query: ast.Insert):
         """Sends reply emails using the Gmail "users.messages.send" API
@@ -281,9 +366,17 @@ class GmailHandler(APIHandler):
         self.scopes = self.connection_args.get('scopes', DEFAULT_SCOPES)
         self.token_file = None
         self.max_page_size = 500
-        self.max_batch_size = 100
+        self.max_batch_size = 50
+        self.max_workers = 2
+        self.max_retries = 5
+        self.retry_delay = 1
+        self.quota_units_per_second = QUOTA_UNITS_PER_SECOND
+        self._quota_lock = threading.Lock()
+        self._quota_available_at = 0
         self.service = None
+        self.credentials = None
         self.is_connected = False
+        self._thread_local = threading.local()
 
         self.storage = HandlerStorage(kwargs['integration_id'])
 
@@ -331,8 +424,12 @@ class GmailHandler(APIHandler):
             with open(token_file, 'w') as token:
                 token.write(creds.to_json())
 
-        self.storage.folder_sync('config')
-        return build('gmail', 'v1', credentials=creds)
+            # Only push the config folder back to storage when its files changed
+            self.storage.folder_sync('config')
+
+        self.credentials = creds
+        # Use the discovery document bundled with the client library instead of fetching it
+        return build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
 
     def connect(self) -> object:
         """Authenticate with the Gmail API using the credentials file.
@@ -381,22 +478,26 @@ class GmailHandler(APIHandler):
         return response
 
     def native_query(self, query_string: str = None) -> Response:
-        ast = parse_sql(query_string, dialect="mindsdb")
+        query = parse_sql(query_string, dialect="mindsdb")
 
-        return self.query(ast)
+        return self.query(query)
 
     def _parse_parts(self, parts, attachments):
         if not parts:
             return ''
 
-        body = ''
+        # Decoded chunks are joined once instead of growing a string part by part
+        body = []
+        self._collect_parts(parts, attachments, body)
+        return ''.join(body)
+
+    def _collect_parts(self, parts, attachments, body):
         for part in parts:
             if part['mimeType'] == 'text/plain':
-                part_body = part.get('body', {}).get('data', '')
-                body += urlsafe_b64decode(part_body).decode('utf-8')
+                body.append(_decode_text_part(part))
             elif part['mimeType'] == 'multipart/alternative' or 'parts' in part:
                 # Recursively iterate over nested parts to find the plain text body
-                body += self._parse_parts(part['parts'], attachments)
+                self._collect_parts(part.get('parts', []), attachments, body)
             elif part.get('filename') and part.get('body') and part.get('body').get('attachmentId'):
                 # For now just store the attachment details
                 attachments.append({
@@ -405,18 +506,23 @@ class GmailHandler(APIHandler):
                     'attachmentId': part['body']['attachmentId']
                 })
             else:
-                log.logger.debug(f"Unhandled mimeType: {part['mimeType']}")
-
-        return body
+                log.logger.debug('Unhandled mimeType: %s', part['mimeType'])
 
-    def _parse_message(self, data, message, exception):
+    def _parse_message(self, rows, failed, request_id, message, exception):
         if exception:
-            log.logger.error(f'Exception in getting full email: {exception}')
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                # The email was deleted after being listed
+                log.logger.error('Exception in getting full email: %s', exception)
+            else:
+                failed[request_id] = exception
             return
 
-        payload = message['payload']
+        payload = message.get('payload', {})
         headers = payload.get("headers", [])
         parts = payload.get("parts")
+        if parts is None and 'body' in payload:
+            # Single part messages carry their body in the payload itself
+            parts = [payload]
 
         row = {
             'id': message['id'],
@@ -428,28 +534,60 @@ class GmailHandler(APIHandler):
         }
 
         for header in headers:
-            key = header['name'].lower()
-            value = header['value']
-
-            if key in ['to', 'subject', 'date']:
-                row[key] = value
-            elif key == 'from':
-                row['sender'] = value
-            elif key == 'message-id':
-                row['message_id'] = value
+            column = _HEADER_COLUMNS_BY_NAME.get(header['name'].lower())
+            if column is not None:
+                row[column] = header['value']
 
         attachments = []
         row['body'] = self._parse_parts(parts, attachments)
         row['attachments'] = json.dumps(attachments)
-        data.append(row)
+        rows[request_id] = row
+
+    def _new_columns(self) -> dict:
+        return {column: [] for column in EmailsTable.COLUMNS}
+
+    def _get_messages(self, messages, message_format='full', limit_exec_time=float('inf'), cancelled=None):
+        if cancelled is None:
+            cancelled = threading.Event()
+
+        params = {'userId': 'me', 'format': message_format, 'fields': MESSAGE_FIELDS[message_format]}
+        if message_format == 'metadata':
+            params['metadataHeaders'] = MESSAGE_HEADERS
+
+        rows = {}
+        failed = {}
+        ids = [message['id'] for message in messages]
+        for attempt in range(self.max_retries + 1):
+            if cancelled.is_set():
+                raise RuntimeError('Handler request cancelled')
+            if attempt > 0:
+                # Exponential backoff with jitter, unless the API asked to wait longer
+                delay = self.retry_delay * 2 ** (attempt - 1) + random.uniform(0, self.retry_delay)
+                _sleep(max(delay, *map(_retry_after, failed.values())), limit_exec_time, cancelled)
+
+            self._wait_for_quota(len(ids) * MESSAGE_GET_QUOTA_UNITS, limit_exec_time, cancelled)
+            failed = {}
+            batch_req = self.service.new_batch_http_request(partial(self._parse_message, rows, failed))
+            for id in ids:
+                batch_req.add(self.service.users().messages().get(id=id, **params), request_id=id)
+            batch_req.execute(http=self._get_http())
+
+            ids = list(failed)
+            if not ids or not all(map(_is_retryable, failed.values())):
+                break
 
-    def _get_messages(self, data, messages):
-        batch_req = self.service.new_batch_http_request(
-            lambda id, response, exception: self._parse_message(data, response, exception))
-        for message in messages:
-            batch_req.add(self.service.users().messages().get(userId='me', id=message['id']))
+        if ids:
+            error = next((e for e in failed.values() if not _is_retryable(e)), failed[ids[0]])
+            raise RuntimeError(f'Failed to get {len(ids)} emails from Gmail API: {error}')
 
-        batch_req.execute()
+        # Put the rows back in the order of the listing, retried messages arrive last
+        data = self._new_columns()
+        for message in messages:
+            row = rows.get(message['id'])
+            if row is not None:
+                for column, values in data.items():
+                    values.append(row.get(column))
+        return data
 
     def get_attachments(self, result):
         for index, email in result.iterrows():
@@ -460,26 +598,135 @@ class GmailHandler(APIHandler):
                 mimeType = attachment['mimeType']
                 attachment_data = self.service.users().messages().attachments().get(
                     userId='me', messageId=email['id'], id=attachment_id).execute()
-                file_data = attachment_data['data']
-                file_data = file_data.replace('-', '+').replace('_', '/')
-                file_data = urlsafe_b64decode(file_data)
+                file_data = _decode_base64url(attachment_data['data'])
                 with open(filename, 'wb') as f:
                     f.write(file_data)
 
-    def _handle_list_messages_response(self, data, messages):
-        total_pages = len(messages) // self.max_batch_size
-        for page in range(total_pages):
-            self._get_messages(data, messages[page * self.max_batch_size:(page + 1) * self.max_batch_size])
+    def _wait_for_quota(self, units, limit_exec_time, cancelled):
+        """Spaces out the requests of all the worker threads to stay within the per-user quota"""
+        with self._quota_lock:
+            now = _clock()
+            start = max(now, self._quota_available_at)
+            self._quota_available_at = start + units / self.quota_units_per_second
+        if start > now:
+            _sleep(start - now, limit_exec_time, cancelled)
+
+    def _get_http(self):
+        """Returns an authorized http object owned by the calling thread.
+
+        httplib2 connections are not thread-safe, so requests executed from worker
+        threads must not share the http object of the service.
+        """
+        http = getattr(self._thread_local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            self._thread_local.http = http
+        return http
 
-        # Get the remaining messsages, if any
-        if len(messages) % self.max_batch_size > 0:
-            self._get_messages(data, messages[total_pages * self.max_batch_size:])
+    def _execute_request(self, request):
+        return request.execute(http=self._get_http())
 
-    def call_gmail_api(self, method_name: str = None, params: dict = None) -> pd.DataFrame:
+    @staticmethod
+    def _wait_for(future, limit_exec_time):
+        try:
+            return future.result(timeout=max(limit_exec_time - _clock(), 0))
+        except FuturesTimeoutError:
+            raise RuntimeError('Handler request timeout error')
+
+    def _handle_list_messages_response(self, data, messages, executor, limit_exec_time, cancelled,
+                                       message_format='full'):
+        # Gmail accepts up to max_batch_size requests per batch, the batches are executed concurrently
+        futures = [
+            executor.submit(self._get_messages, messages[start:start + self.max_batch_size], message_format,
+                            limit_exec_time, cancelled)
+            for start in range(0, len(messages), self.max_batch_size)
+        ]
+
+        try:
+            # Collect in submission order to keep the order of the listing
+            for future in futures:
+                for column, values in self._wait_for(future, limit_exec_time).items():
+                    data[column].extend(values)
+        finally:
+            # Batches not started yet are dropped if the listing failed
+            for future in futures:
+                future.cancel()
+
+    def _iter_messages(self, method, params: dict, count_results: int = None, message_format: str = 'full'):
+        """Pages through "users.messages.list" and yields the details of the listed messages page by page.
+
+        The next page of ids is requested from a worker thread while the details of the
+        current page are being fetched, so both round-trips overlap. The details themselves
+        are fetched in concurrent batches. Waiting on the workers is bounded by the request
+        timeout, requests still in flight when it expires are abandoned and their batches
+        stop before the next retry.
+
+        Args:
+            method: bound "users.messages.list" method
+            params (dict): query parameters
+            count_results (int): maximum number of messages to return, only the first page is fetched if None
+            message_format (str): format of the fetched messages, 'metadata' skips the message bodies
+        Yields:
+            Dict of column values for each page
+        """
+        if count_results == 0:
+            yield self._new_columns()
+            return
+
+        fetched = 0
+        limit_exec_time = _clock() + 60
+
+        params.setdefault('fields', LIST_MESSAGES_FIELDS)
+        if count_results is not None:
+            params['maxResults'] = min(count_results, self.max_page_size)
+
+        future = None
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            log.logger.debug('Calling Gmail API: list_messages with params (%s)', params)
+            resp = method(**params).execute()
+
+            while resp is not None:
+                if _clock() > limit_exec_time:
+                    raise RuntimeError('Handler request timeout error')
+
+                future = None
+
+                messages = resp.get('messages', [])
+                if count_results is not None:
+                    # got more results that we need
+                    messages = messages[:count_results - fetched]
+                fetched += len(messages)
+
+                if count_results is not None and fetched < count_results and 'nextPageToken' in resp:
+                    params['pageToken'] = resp['nextPageToken']
+                    params['maxResults'] = min(count_results - fetched, self.max_page_size)
+
+                    log.logger.debug('Calling Gmail API: list_messages with params (%s)', params)
+                    future = executor.submit(self._execute_request, method(**params))
+
+                page = self._new_columns()
+                self._handle_list_messages_response(page, messages, executor, limit_exec_time, cancelled,
+                                                    message_format)
+                yield page
+
+                resp = self._wait_for(future, limit_exec_time) if future is not None else None
+        finally:
+            # Nothing new starts after a failure and requests in flight are not waited for.
+            # shutdown(cancel_futures=True) needs python 3.9, so the queued page is cancelled here.
+            # Batches already running stop before their next retry or wait
+            cancelled.set()
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def call_gmail_api(self, method_name: str = None, params: dict = None, message_format: str = 'full') -> pd.DataFrame:
         """Call Gmail API and map the data to pandas DataFrame
         Args:
             method_name (str): method name
             params (dict): query parameters
+            message_format (str): format of the listed messages, 'full' or 'metadata'
         Returns:
             DataFrame
         """
@@ -495,47 +742,20 @@ class GmailHandler(APIHandler):
         else:
             raise NotImplementedError(f'Unknown method_name: {method_name}')
 
-        left = None
-        count_results = None
-        if 'maxResults' in params:
-            count_results = params['maxResults']
-
         params['userId'] = 'me'
 
-        data = []
-        limit_exec_time = time.time() + 60
-
-        while True:
-            if time.time() > limit_exec_time:
-                raise RuntimeError('Handler request timeout error')
-
-            if count_results is not None:
-                left = count_results - len(data)
-                if left == 0:
-                    break
-                elif left < 0:
-                    # got more results that we need
-                    data = data[:left]
-                    break
-
-                if left > self.max_page_size:
-                    params['maxResults'] = self.max_page_size
-                else:
-                    params['maxResults'] = left
-
-            log.logger.debug(f'Calling Gmail API: {method_name} with params ({params})')
+        if method_name == 'list_messages':
+            pages = self._iter_messages(method, params, params.get('maxResults'), message_format)
 
-            resp = method(**params).execute()
+            # Pages are converted as they arrive, their column lists are released right after
+            return pd.concat([pd.DataFrame(page, copy=False) for page in pages], ignore_index=True)
 
-            if 'messages' in resp:
-                self._handle_list_messages_response(data, resp['messages'])
-            elif isinstance(resp, dict):
-                data.append(resp)
+        log.logger.debug(f'Calling Gmail API: {method_name} with params ({params})')
 
-            if count_results is not None and 'nextPageToken' in resp:
-                params['pageToken'] = resp['nextPageToken']
-            else:
-                break
+        data = []
+        resp = method(**params).execute()
+        if isinstance(resp, dict):
+            data.append(resp)
 
         df = pd.DataFrame(data)
 
@@ -1,8 +1,17 @@
 from mindsdb.api.mysql.mysql_proxy.libs.constants.response_type import RESPONSE_TYPE
 from mindsdb.integrations.handlers.gmail_handler.gmail_handler import GmailHandler
 from mindsdb.integrations.handlers.gmail_handler.gmail_handler import EmailsTable
+from mindsdb.integrations.handlers.gmail_handler.gmail_handler import _retry_after
 from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+from base64 import urlsafe_b64encode
 from mindsdb_sql import parse_sql
+import pandas as pd
+import itertools
+import json
+import threading
+import time
 import unittest
 from unittest.mock import Mock, patch
 from unittest import mock
@@ -237,3 +246,280 @@ class EmailsTableTest(unittest.TestCase):
         gmail_handler.call_gmail_api.assert_called_once_with('modify_message', {'id': 1,
                                                                                 'body': {'addLabelIds': ['test1'],
                                                                                          'removeLabelIds': ['test']}})
+
+    def test_select_without_body_fetches_metadata(self):
+        gmail_handler = Mock(GmailHandler)
+        gmail_handler.call_gmail_api.return_value = pd.DataFrame()
+        gmail_table = EmailsTable(gmail_handler)
+        query = parse_sql('select id, subject from gmail limit 10', dialect='mindsdb')
+        gmail_table.select(query)
+        gmail_handler.call_gmail_api.assert_called_once_with(method_name='list_messages',
+                                                             params={'maxResults': 10},
+                                                             message_format='metadata')
+
+    def test_select_with_body_fetches_full_messages(self):
+        gmail_handler = Mock(GmailHandler)
+        gmail_handler.call_gmail_api.return_value = pd.DataFrame()
+        gmail_table = EmailsTable(gmail_handler)
+        query = parse_sql('select id, body from gmail limit 10', dialect='mindsdb')
+        gmail_table.select(query)
+        gmail_handler.call_gmail_api.assert_called_once_with(method_name='list_messages',
+                                                             params={'maxResults': 10},
+                                                             message_format='full')
+
+
+class FakeBatchHttpRequest:
+    """Executes the added requests in order and passes the messages to the batch callback"""
+
+    def __init__(self, callback, messages):
+        self.callback = callback
+        self.messages = messages
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, self.messages(request), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class ListMessagesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        with patch('mindsdb.integrations.handlers.gmail_handler.gmail_handler.HandlerStorage'):
+            self.handler = GmailHandler('test_gmail_handler', connection_data={}, integration_id=1)
+
+        self.handler.credentials = Credentials('token')
+        self.handler.service = Mock()
+        self.handler.is_connected = True
+        # No waiting between retries and no pacing against the quota
+        self.handler.retry_delay = 0
+        self.handler.quota_units_per_second = float('inf')
+
+        self.listed = [{'id': f'id{index}', 'threadId': f'thread{index}'} for index in range(1200)]
+        self.list_params = []
+        # Number of times getting a message fails with the given status before succeeding
+        self.failures = {}
+        self.requested = []
+
+        messages = self.handler.service.users.return_value.messages.return_value
+        messages.list.side_effect = self._list
+        # Requests are only passed around, keep their parameters to answer them
+        messages.get.side_effect = lambda **params: params
+        self.handler.service.new_batch_http_request.side_effect = \
+            lambda callback: FakeBatchHttpRequest(callback, self._get_message)
+
+    def _list(self, **params):
+        self.list_params.append(dict(params))
+
+        # maxResults=0 falls back to the default page size, like other invalid values
+        start = int(params.get('pageToken', 0))
+        end = start + (params.get('maxResults') or 100)
+        response = {'messages': self.listed[start:end]} if self.listed[start:end] else {}
+        if end < len(self.listed):
+            response['nextPageToken'] = str(end)
+        return Mock(**{'execute.return_value': response})
+
+    def _get_message(self, request):
+        self.requested.append(request['id'])
+        status, count = self.failures.get(request['id'], (None, 0))
+        if count > 0:
+            self.failures[request['id']] = (status, count - 1)
+            raise HttpError(Response({'status': status}), b'')
+
+        return {
+            'id': request['id'],
+            'threadId': 'thread',
+            'historyId': '1',
+            'payload': {
+                'headers': [{'name': 'Subject', 'value': f'subject of {request["id"]}'}]
+            }
+        }
+
+    def test_limit_fetches_remaining_results_per_page(self):
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 600}, 'metadata')
+        self.assertEqual(len(result), 600)
+        self.assertListEqual([params['maxResults'] for params in self.list_params], [500, 100])
+        self.assertListEqual([params.get('pageToken') for params in self.list_params], [None, '500'])
+
+    def test_listing_order_is_kept_across_batches(self):
+        get_message = self._get_message
+
+        def slow_first_batch(request):
+            # The first batch finishes last
+            if request['id'] == 'id0':
+                time.sleep(0.1)
+            return get_message(request)
+
+        self._get_message = slow_first_batch
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 700}, 'metadata')
+        self.assertListEqual(list(result['id']), [message['id'] for message in self.listed[:700]])
+        self.assertEqual(result['subject'][650], 'subject of id650')
+        self.assertEqual(self.handler.service.new_batch_http_request.call_count, 14)
+
+    def test_empty_listing(self):
+        self.listed = []
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 10}, 'metadata')
+        self.assertEqual(len(result), 0)
+        self.assertListEqual(list(result.columns), list(EmailsTable.COLUMNS))
+        self.handler.service.new_batch_http_request.assert_not_called()
+
+    def test_iter_messages_yields_each_page(self):
+        method = self.handler.service.users().messages().list
+        pages = self.handler._iter_messages(method, {'userId': 'me'}, 600, 'metadata')
+        self.assertListEqual([len(page['id']) for page in pages], [500, 100])
+
+    def test_listing_timeout(self):
+        with patch('mindsdb.integrations.handlers.gmail_handler.gmail_handler._clock',
+                   side_effect=itertools.count(0, 100)):
+            with self.assertRaisesRegex(RuntimeError, 'timeout'):
+                self.handler.call_gmail_api('list_messages', {'maxResults': 600}, 'metadata')
+
+    def test_limit_zero_does_not_call_api(self):
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 0}, 'metadata')
+        self.assertEqual(len(result), 0)
+        self.assertListEqual(list(result.columns), list(EmailsTable.COLUMNS))
+        self.assertEqual(self.list_params, [])
+
+    def test_limit_above_page_size_pages_through_results(self):
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 1100}, 'metadata')
+        self.assertEqual(len(result), 1100)
+        self.assertListEqual([params['maxResults'] for params in self.list_params], [500, 500, 100])
+        self.assertListEqual([params.get('pageToken') for params in self.list_params], [None, '500', '1000'])
+
+    def test_no_limit_fetches_first_page_only(self):
+        result = self.handler.call_gmail_api('list_messages', {}, 'metadata')
+        self.assertEqual(len(result), 100)
+        self.assertEqual(len(self.list_params), 1)
+        self.assertNotIn('maxResults', self.list_params[0])
+
+    def test_failed_messages_are_retried_in_listing_order(self):
+        self.failures = {'id1': (429, 1), 'id3': (500, 2)}
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 5}, 'metadata')
+        self.assertListEqual(list(result['id']), ['id0', 'id1', 'id2', 'id3', 'id4'])
+        self.assertListEqual(self.requested[5:], ['id1', 'id3', 'id3'])
+
+    def test_messages_failing_after_retries_raise(self):
+        self.failures = {'id1': (429, self.handler.max_retries + 1)}
+        with self.assertRaises(RuntimeError):
+            self.handler.call_gmail_api('list_messages', {'maxResults': 5}, 'metadata')
+        self.assertEqual(self.requested.count('id1'), self.handler.max_retries + 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.failures = {'id1': (403, 1), 'id3': (429, 1)}
+        with self.assertRaisesRegex(RuntimeError, '403'):
+            self.handler.call_gmail_api('list_messages', {'maxResults': 5}, 'metadata')
+        self.assertEqual(len(self.requested), 5)
+
+    def test_retries_stop_when_cancelled(self):
+        cancelled = threading.Event()
+        get_message = self._get_message
+
+        def cancel_on_failure(request):
+            # The listing fails while the batch is running
+            if request['id'] == 'id1':
+                cancelled.set()
+            return get_message(request)
+
+        self._get_message = cancel_on_failure
+        self.failures = {'id1': (429, 1)}
+        with self.assertRaisesRegex(RuntimeError, 'cancelled'):
+            self.handler._get_messages(self.listed[:3], 'metadata', float('inf'), cancelled)
+        self.assertListEqual(self.requested, ['id0', 'id1', 'id2'])
+
+    def test_retries_stop_before_timeout(self):
+        self.handler.retry_delay = 60
+        self.failures = {'id1': (429, 1)}
+        with self.assertRaisesRegex(RuntimeError, 'timeout'):
+            self.handler._get_messages(self.listed[:3], 'metadata', time.monotonic() + 1, threading.Event())
+        self.assertListEqual(self.requested, ['id0', 'id1', 'id2'])
+
+    def test_retry_after_header(self):
+        self.assertEqual(_retry_after(HttpError(Response({'status': 429, 'retry-after': '3'}), b'')), 3)
+        self.assertEqual(_retry_after(HttpError(Response({'status': 503}), b'')), 0)
+
+    def test_deleted_messages_are_skipped(self):
+        self.failures = {'id1': (404, 1)}
+        result = self.handler.call_gmail_api('list_messages', {'maxResults': 3}, 'metadata')
+        self.assertListEqual(list(result['id']), ['id0', 'id2'])
+
+
+class ParseMessageTest(unittest.TestCase):
+    def setUp(self) -> None:
+        with patch('mindsdb.integrations.handlers.gmail_handler.gmail_handler.HandlerStorage'):
+            self.handler = GmailHandler('test_gmail_handler', connection_data={}, integration_id=1)
+
+    def test_parse_metadata_message(self):
+        message = {
+            'id': 'id0',
+            'threadId': 'thread0',
+            'labelIds': ['INBOX'],
+            'snippet': 'snippet',
+            'historyId': '1',
+            'sizeEstimate': 10,
+            'payload': {
+                'headers': [
+                    {'name': 'From', 'value': 'sender@example.com'},
+                    {'name': 'Message-Id', 'value': '<id0@example.com>'},
+                    {'name': 'X-Mailer', 'value': 'mailer'},
+                ]
+            }
+        }
+        rows, failed = {}, {}
+        self.handler._parse_message(rows, failed, 'id0', message, None)
+
+        row = rows['id0']
+        self.assertEqual(row['sender'], 'sender@example.com')
+        self.assertEqual(row['message_id'], '<id0@example.com>')
+        self.assertNotIn('subject', row)
+        self.assertEqual(row['body'], '')
+        self.assertEqual(json.loads(row['attachments']), [])
+        self.assertEqual(failed, {})
+
+    def test_parse_single_part_message_with_unpadded_body(self):
+        message = {
+            'id': 'id0',
+            'threadId': 'thread0',
+            'historyId': '1',
+            'payload': {
+                'mimeType': 'text/plain',
+                'headers': [],
+                # "hi" without the trailing "=" padding
+                'body': {'data': 'aGk'}
+            }
+        }
+        rows = {}
+        self.handler._parse_message(rows, {}, 'id0', message, None)
+        self.assertEqual(rows['id0']['body'], 'hi')
+
+    def test_parse_message_decodes_part_charset(self):
+        latin1 = urlsafe_b64encode('café'.encode('latin-1')).decode()
+        message = {
+            'id': 'id0',
+            'threadId': 'thread0',
+            'historyId': '1',
+            'payload': {
+                'mimeType': 'multipart/alternative',
+                'headers': [],
+                'parts': [
+                    {
+                        'mimeType': 'text/plain',
+                        'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="ISO-8859-1"'}],
+                        'body': {'data': latin1}
+                    },
+                    {
+                        # Latin-1 bytes without a declared charset
+                        'mimeType': 'text/plain',
+                        'headers': [],
+                        'body': {'data': latin1}
+                    },
+                ]
+            }
+        }
+        rows, failed = {}, {}
+        self.handler._parse_message(rows, failed, 'id0', message, None)
+        self.assertEqual(rows['id0']['body'], 'café' + 'caf\ufffd')
+        self.assertEqual(failed, {})